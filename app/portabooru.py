@@ -1,19 +1,38 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util import Retry
 import json
+try:
+    import orjson
+except ImportError: # NOTE: orjson is optional, the standard json module is used if it is not installed
+    orjson = None
 import math
 from tqdm import tqdm
-from multiprocessing import Pool, cpu_count
+from concurrent.futures import ThreadPoolExecutor, wait
 import logging
-import glob
+import shutil
+import atexit
+import threading
+import queue
+from collections import deque
+from urllib.parse import urlencode, quote_plus
+from typing import Iterator
 
 
 INPUT_FOLDER = "./inputs"
 OUTPUT_FOLDER = "./outputs"
 BASE_URL = "https://danbooru.donmai.us"
 MAX_ITEMS_PER_PAGE = 200
-SUCCESSIVE_ERRORS_LIMIT = 5
+PAGES_IN_FLIGHT = 8
+RETRIES_LIMIT = 5
+REQUEST_TIMEOUT = 30
+DOWNLOAD_WORKERS = min(32, (os.cpu_count() or 4) * 4)
+DOWNLOAD_QUEUE_SIZE = 2000
 FORBIDDEN_EXTENSIONS = [] # ["mp4", "zip"]
+INFOS_INDENT = None # 4 for human-readable infos files
+SANITIZE_TABLE = str.maketrans({char: "_" for char in '<>:"\\|?*'}) # NOTE: characters that are not allowed in folder names
 STATUS_CODE = {
     200: "OK",
     204: "No Content",
@@ -29,9 +48,60 @@ STATUS_CODE = {
     429: "User Throttled",
     500: "Internal Server Error",
     502: "Bad Gateway",
-    503: "Service Unavailable"
+    503: "Service Unavailable",
+    504: "Gateway Timeout"
 }
 
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=RETRIES_LIMIT,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        raise_on_status=False, # NOTE: the last response is returned so that its status code can be handled by the caller
+    ),
+))
+
+_MANIFEST_FDS = {}
+_MANIFEST_LOCK = threading.Lock()
+
+
+def get_manifest_fd(path: str) -> int:
+    """
+    Returns a file descriptor on the given manifest opened in append mode, opening it on first use.
+    Appends through a single O_APPEND descriptor are atomic, so it can be shared by all the threads.
+
+    Parameters
+    ----------
+    * path (str): the path of the manifest
+
+    Returns
+    -------
+    * (int): the file descriptor of the manifest
+    """
+    with _MANIFEST_LOCK:
+        if path not in _MANIFEST_FDS:
+            _MANIFEST_FDS[path] = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        return _MANIFEST_FDS[path]
+
+
+@atexit.register
+def close_manifests() -> None:
+    """
+    Closes all the manifests opened by get_manifest_fd.
+
+    Returns
+    -------
+    None
+    """
+    with _MANIFEST_LOCK:
+        for fd in _MANIFEST_FDS.values():
+            os.close(fd)
+        _MANIFEST_FDS.clear()
+
 
 def login(username: str, api_key: str) -> None:
     """
@@ -51,41 +121,43 @@ def login(username: str, api_key: str) -> None:
         'login': username,
         'api_key': api_key
     }
-    response = requests.get(f"{BASE_URL}/users.json", params=params)
+    response = SESSION.get(f"{BASE_URL}/users.json", params=params, timeout=REQUEST_TIMEOUT)
     if response.status_code != 200:
-        logging.info(f"failed (status code: {response.status_code}: {STATUS_CODE[response.status_code]}).")
+        logging.info(f"failed (status code: {response.status_code}: {STATUS_CODE.get(response.status_code, 'Unknown')}).")
         exit(1)
     logging.info("success!")
 
 
-def unpack(args):
+def get_output_folder(tag: str) -> str:
     """
-    Unpacks the arguments and calls the function with the unpacked arguments.
+    Returns the folder in which the images of the given tag are saved.
 
     Parameters
     ----------
-    * args (list): the arguments to unpack, where the first argument is the function to call
+    * tag (str): the tag to search for
+
+    Returns
+    -------
+    * (str): the path of the folder, with the characters not allowed in folder names replaced
     """
-    func = args[0]
-    args = args[1:]
-    return func(*args)
+    return os.path.join(OUTPUT_FOLDER, tag.translate(SANITIZE_TABLE))
 
 
-def download_image(info: dict, tag: str, only_infos: bool = False) -> None:
+def download_image(info: dict, out_base: str, manifest_path: str, only_infos: bool = False) -> None:
     """
     Downloads the image and saves all its tags as well as all the image informations in files.
 
     Parameters
     ----------
     * info (dict): the image informations as a dictionary
-    * tag (str): the tag to search for
+    * out_base (str): the output folder of the tag, as returned by get_output_folder
+    * manifest_path (str): the path of the manifest of the tag
     * only_infos (bool): whether to only download the infos of the images
 
     Returns
     -------
     None
     """
-    downloaded_ids = get_downloaded_ids(tag)
     logging.debug("Reading image informations...")
     try:
         id = info['id']
@@ -96,23 +168,13 @@ def download_image(info: dict, tag: str, only_infos: bool = False) -> None:
     except KeyError:
         logging.debug("ignored (wrong formatting).")
         return
-    if id in downloaded_ids:
-        logging.debug("ignored (already downloaded).")
-        return
-    formatted_tag = tag
-    for chars in ["<", ">", ":", "\"", "\\", "|", "?", "*"]:
-        while chars in formatted_tag:
-            formatted_tag = formatted_tag.replace(chars, "_")
-    path = os.path.join(OUTPUT_FOLDER, formatted_tag, rating)
-    if not os.path.exists(path):
-        try:
-            os.makedirs(path)
-        except FileExistsError: # necessary since multiprocessing could lead to multiple processes trying to create the same directory at the same time
-            pass
+    path = os.path.join(out_base, rating)
+    os.makedirs(path, exist_ok=True) # NOTE: multiple threads could be trying to create the same directory at the same time
     imagepath = os.path.join(path, f"{id}_image.{extension}")
     tagspath = os.path.join(path, f"{id}_tags.txt")
     jsonpath = os.path.join(path, f"{id}_infos.json")
     if os.path.exists(imagepath) and os.path.exists(tagspath) and os.path.exists(jsonpath):
+        os.write(get_manifest_fd(manifest_path), f"{id}\n".encode()) # NOTE: the image was listed, so it is missing from the manifest (e.g. after a crash)
         logging.debug("ignored (already exists).")
         return
     logging.debug(f"trying to download image with id '{id}'...")
@@ -121,19 +183,33 @@ def download_image(info: dict, tag: str, only_infos: bool = False) -> None:
         return
     if not only_infos:
         try:
-            image_response = requests.get(image_url)
-        except requests.exceptions.ConnectionError:
+            with SESSION.get(image_url, stream=True, timeout=REQUEST_TIMEOUT) as image_response:
+                image_response.raise_for_status()
+                image_response.raw.decode_content = True
+                with open(imagepath, "wb") as f:
+                    shutil.copyfileobj(image_response.raw, f, length=64 * 1024)
+        except requests.exceptions.HTTPError as e:
+            logging.debug(f"ignored (status code: {e.response.status_code}).")
+            return
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError): # NOTE: reading from the raw stream raises urllib3 errors
+            try:
+                os.remove(imagepath) # NOTE: the download may have failed halfway, leaving a truncated image
+            except FileNotFoundError:
+                pass
             logging.debug("ignored (connection error).")
             return
-        image_data = image_response.content
-        with open(imagepath, "wb") as f:
-            f.write(image_data)
     with open(tagspath, "w") as f:
         f.write("\n".join(tags.split(" ")))
-    with open(jsonpath, "w") as f:
-        json.dump(info, f, indent=4)
-    with open(os.path.join(OUTPUT_FOLDER, formatted_tag, "manifest.txt"), "a") as f:
-        f.write(f"{id}\n")
+    if orjson is not None and INFOS_INDENT is None:
+        with open(jsonpath, "wb") as f:
+            f.write(orjson.dumps(info))
+    else:
+        with open(jsonpath, "w", buffering=1 << 16) as f:
+            if INFOS_INDENT is None:
+                f.write(json.dumps(info, separators=(",", ":"))) # NOTE: unlike json.dump, json.dumps uses the C-accelerated encoder
+            else:
+                json.dump(info, f, indent=INFOS_INDENT)
+    os.write(get_manifest_fd(manifest_path), f"{id}\n".encode())
     logging.debug("done!")
 
 
@@ -149,12 +225,30 @@ def get_images_count(tag: str) -> int:
     -------
     * (int): the number of images corresponding to the given tag
     """
-    count_url = f"{BASE_URL}/tags.json?search[name]={tag}"
-    response = requests.get(count_url)
+    response = SESSION.get(f"{BASE_URL}/tags.json", params={"search[name]": tag}, timeout=REQUEST_TIMEOUT)
     return response.json()[0]['post_count']
 
 
-def get_downloaded_ids(tag: str, rating: str | None = None) -> list[int]:
+def scan_folder(path: str) -> list[os.DirEntry]:
+    """
+    Returns the entries of the given folder, or an empty list if it does not exist.
+
+    Parameters
+    ----------
+    * path (str): the folder to scan
+
+    Returns
+    -------
+    * (list[os.DirEntry]): the entries of the folder
+    """
+    try:
+        with os.scandir(path) as entries:
+            return list(entries)
+    except FileNotFoundError:
+        return []
+
+
+def get_downloaded_ids(tag: str, rating: str | None = None) -> set[int]:
     """
     Returns the IDs of the images that have already been downloaded.
 
@@ -165,94 +259,210 @@ def get_downloaded_ids(tag: str, rating: str | None = None) -> list[int]:
 
     Returns
     -------
-    * (list[int]): the IDs of the images that have already been downloaded
+    * (set[int]): the IDs of the images that have already been downloaded
     """
-    path = os.path.join(OUTPUT_FOLDER, tag)
-    if rating is not None:
-        path = os.path.join(path, rating)
-    files = glob.glob(f"{path}/*/*_infos.json", recursive=True)
-    ids = [int(os.path.basename(file).split("_")[0]) for file in files]
-    manifest_ids = []
-    try:
-        manifest_ids = open(os.path.join(path, "manifest.txt"), "r").read().splitlines()
-    except FileNotFoundError:
-        pass
+    path = get_output_folder(tag)
+    if rating is None:
+        # NOTE: the manifest is appended to after each download and does not depend on the rating, so it can be trusted over a scan of the output folder
+        try:
+            with open(os.path.join(path, "manifest.txt"), "r") as f:
+                return {int(line) for line in f.read().splitlines() if line}
+        except FileNotFoundError:
+            pass
+        folders = [entry.path for entry in scan_folder(path) if entry.is_dir()]
+    else:
+        folders = [os.path.join(path, rating)]
+    ids = set()
+    for folder in folders:
+        for entry in scan_folder(folder):
+            if entry.name.endswith("_infos.json"):
+                ids.add(int(entry.name.split("_", 1)[0]))
     return ids
 
-def get_images_infos(tag: str, limit: int | None = None, rating: str | None = None) -> list[dict]:
+def build_posts_query(tag: str, rating: str | None = None) -> str:
     """
-    Makes a request to the API to get the informations of multiple images corresponding to the given tag. Images are sorted by ID, oldest first.
+    Returns the encoded query string used to search for the posts corresponding to the given tag, without the page number.
 
     Parameters
     ----------
     * tag (str): the tag to search for
-    * limit (int | None): the maximum number of images to download if specified
     * rating (str | None): the rating of the images to download if specified
 
     Returns
     -------
-    * (list[dict]): the informations of the images as a list of dictionaries
+    * (str): the encoded query string
+    """
+    tags = tag if rating is None else f"{tag} rating:{rating}"
+    params = {
+        'tags': tags,
+        'limit': MAX_ITEMS_PER_PAGE
+    }
+    # NOTE: tags are separated by spaces, which are encoded as "+" as expected by the API, while special characters in the tag are escaped
+    return urlencode(params, safe=":()", quote_via=quote_plus)
+
+
+def get_page_infos(query: str, page: int) -> list[dict] | None:
+    """
+    Makes a request to the API to get a single page of images informations.
+
+    Parameters
+    ----------
+    * query (str): the encoded query string, as returned by build_posts_query
+    * page (int): the number of the page to request, starting at 1
+
+    Returns
+    -------
+    * (list[dict] | None): the informations of the images of the page, or None if the page had to be skipped
+    """
+    images_url = f"{BASE_URL}/posts.json?{query}&page={page}"
+    # NOTE: retries with backoff are handled by the adapter mounted on SESSION
+    try:
+        response = SESSION.get(images_url, timeout=REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException:
+        logging.info(f"❌ Connection lost. Skipping page {page}.")
+        return None
+    if response.status_code != 200:
+        logging.info(f"❌ Error {response.status_code} ({STATUS_CODE.get(response.status_code, 'Unknown')}). Skipping page {page}.")
+        return None
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+def iter_images_infos(tag: str, limit: int | None = None, rating: str | None = None, downloaded_ids: set[int] | frozenset[int] | None = None) -> Iterator[dict]:
+    """
+    Makes requests to the API to get the informations of multiple images corresponding to the given tag, and yields them as soon as their page is received. Images are sorted by ID, oldest first.
+    Up to PAGES_IN_FLIGHT pages are requested at the same time, and are processed in order.
+
+    Parameters
+    ----------
+    * tag (str): the tag to search for
+    * limit (int | None): the maximum number of images to download if specified
+    * rating (str | None): the rating of the images to download if specified
+    * downloaded_ids (set[int] | frozenset[int] | None): the IDs of the images that have already been downloaded if already known
+
+    Yields
+    ------
+    * (dict): the informations of an image
     """
     logging.info(f"Requesting images infos for tag '{tag}'.")
-    result = []
-    downloaded_ids = get_downloaded_ids(tag, rating)
+    result_count = 0
+    if downloaded_ids is None:
+        downloaded_ids = get_downloaded_ids(tag, rating)
+    seen_ids = set(downloaded_ids)
     if limit is None:
         images_count = get_images_count(tag=tag)
         limit = images_count - len(downloaded_ids)
         logging.info(f"{images_count} images found corresponding to this tag.")
     page_limit = math.ceil(limit / MAX_ITEMS_PER_PAGE)
-    with tqdm(total=limit, desc="Getting images informations", ascii=True) as pbar2:
-        page = 1
-        successive_errors = 0
-        while page <= page_limit:
-            max_items_for_current_page = MAX_ITEMS_PER_PAGE
-            # TODO: improve the following line using for example requests.get(..., params=params)
-            # NOTE: requests.get() automatically encodes the parameters, which is not wanted since a lot of tags contain special characters
-            images_url = f"{BASE_URL}/posts.json?"
-            images_url += f"tags={tag}"
-            if rating is not None:
-                images_url += f"+rating:{rating}"
-            images_url += "&"
-            images_url += f"limit={max_items_for_current_page}&"
-            images_url += f"page={page}&"
-            try:
-                response = requests.get(images_url)
-            except requests.exceptions.ConnectionError:
-                if successive_errors < SUCCESSIVE_ERRORS_LIMIT:
-                    logging.info("❌ Connection lost. Retrying...")
-                    successive_errors += 1
-                    continue
-                else:
-                    logging.info("❌ Connection lost. Skipping current page.")
-                    successive_errors = 0
-                    page += 1
-                    continue
-            if response.status_code != 200:
-                if successive_errors < SUCCESSIVE_ERRORS_LIMIT:
-                    logging.info(f"❌ Error {response.status_code} ({STATUS_CODE[response.status_code]}). Retrying...")
-                    successive_errors += 1
-                    continue
-                else:
-                    logging.info(f"❌ Error {response.status_code} ({STATUS_CODE[response.status_code]}). Skipping current page.")
-                    successive_errors = 0
-                    page += 1
-                    continue
-            items = response.json()
+    query = build_posts_query(tag, rating)
+    with tqdm(total=limit, desc="Getting images informations", ascii=True) as pbar2, ThreadPoolExecutor(max_workers=PAGES_IN_FLIGHT) as executor:
+        pending = deque()
+        next_page = 1
+        while next_page <= page_limit or pending:
+            while next_page <= page_limit and len(pending) < PAGES_IN_FLIGHT:
+                pending.append(executor.submit(get_page_infos, query, next_page))
+                next_page += 1
+            items = pending.popleft().result()
+            if items is None:
+                continue
             if len(items) == 0:
                 logging.debug("❎ Empty page found. Stopping.")
+                for future in pending:
+                    future.cancel()
                 break
+            pbar2.update(len(items))
             for item in items:
                 if 'file_url' not in item:
                     logging.debug(f"❌ Image is not available.") # NOTE: image deleted, banned, premium only, etc.
-                elif item['id'] in downloaded_ids or item in result:
+                elif item['id'] in seen_ids:
                     logging.debug(f"❌ Image already downloaded.")
                 else:
                     logging.debug(f"✅ Image added to download queue.")
-                    result.append(item)
-            page += 1
-            pbar2.update(len(items))
-    logging.info(f"{len(result)} images ready to be downloaded.")
-    return result
+                    seen_ids.add(item['id'])
+                    result_count += 1
+                    yield item
+    logging.info(f"{result_count} images ready to be downloaded.")
+
+
+def get_images_infos(tag: str, limit: int | None = None, rating: str | None = None, downloaded_ids: set[int] | frozenset[int] | None = None) -> list[dict]:
+    """
+    Makes requests to the API to get the informations of multiple images corresponding to the given tag. Images are sorted by ID, oldest first.
+
+    Parameters
+    ----------
+    * tag (str): the tag to search for
+    * limit (int | None): the maximum number of images to download if specified
+    * rating (str | None): the rating of the images to download if specified
+    * downloaded_ids (set[int] | frozenset[int] | None): the IDs of the images that have already been downloaded if already known
+
+    Returns
+    -------
+    * (list[dict]): the informations of the images as a list of dictionaries
+    """
+    return list(iter_images_infos(tag, limit, rating, downloaded_ids))
+
+
+def queue_downloads(tags: list[str], only_metadatas: list[bool], download_queue: queue.Queue, pbar: tqdm, stop_event: threading.Event) -> dict[str, frozenset[int]]:
+    """
+    Requests the informations of the images of each tag and puts them in the download queue, so that the downloads of a tag can start while the next tags are being listed.
+
+    Parameters
+    ----------
+    * tags (list[str]): the tags to search for
+    * only_metadatas (list[bool]): whether to only download the infos of the images, for each tag
+    * download_queue (queue.Queue): the queue to put the (info, out_base, manifest_path, only_infos) arguments of download_image in
+    * pbar (tqdm): the downloads progress bar, whose total is increased as images are found
+    * stop_event (threading.Event): the event that stops the listing once set
+
+    Returns
+    -------
+    * (dict[str, frozenset[int]]): the IDs of the images that were already downloaded before, for each output folder
+    """
+    ids_before = {}
+    for tag, only_metadata in zip(tags, only_metadatas):
+        logging.info(f"Starting collecting images for tag '{tag}'.")
+        tag = tag.strip()
+        try:
+            out_base = get_output_folder(tag)
+            manifest_path = os.path.join(out_base, "manifest.txt")
+            os.makedirs(out_base, exist_ok=True)
+            ids_before[out_base] = frozenset(get_downloaded_ids(tag))
+            for info in iter_images_infos(tag=tag, downloaded_ids=ids_before[out_base]):
+                pbar.total += 1
+                while True: # NOTE: the queue may stay full forever if the workers have been stopped
+                    if stop_event.is_set():
+                        logging.info("❎ Listing stopped.")
+                        return ids_before
+                    try:
+                        download_queue.put((info, out_base, manifest_path, only_metadata), timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception:
+            logging.exception(f"❌ Failed to collect images for tag '{tag}'. Skipping it.") # NOTE: e.g. a misspelled tag, the other tags must still be downloaded
+    return ids_before
+
+
+def download_worker(download_queue: queue.Queue, pbar: tqdm) -> None:
+    """
+    Downloads the images from the download queue until None is found.
+
+    Parameters
+    ----------
+    * download_queue (queue.Queue): the queue containing the arguments of download_image
+    * pbar (tqdm): the downloads progress bar
+
+    Returns
+    -------
+    None
+    """
+    while (args := download_queue.get()) is not None:
+        try:
+            download_image(*args)
+        except Exception:
+            logging.exception(f"❌ Failed to download image with id '{args[0].get('id')}'.") # NOTE: the worker must keep going, otherwise the queue would fill up and block the listing
+        pbar.update()
 
 
 if __name__ == "__main__":
@@ -291,17 +501,42 @@ if __name__ == "__main__":
         logging.info(f"  - {tag}")
     only_metadatas = [True if tags.startswith("*") else False for tags in tags]
     tags = [tags[1:] if tags.startswith("*") else tags for tags in tags]
+    # NOTE: tags sharing an output folder would be listed before the downloads of the first one are in the manifest, leading to duplicated downloads
+    unique_tags = {}
     for tag, only_metadata in zip(tags, only_metadatas):
-        logging.info(f"Starting collecting images for tag '{tag}'.")
         tag = tag.strip()
-        kwargs = {"tag": tag}
-        ids_before = get_downloaded_ids(tag)
-        infos = get_images_infos(**kwargs)
-        logging.info(f"Parallelizing the downloads using {cpu_count()} processes.")
-        with Pool(processes=cpu_count()) as pool:
-            with tqdm(total=len(infos), desc="Downloading images", ascii=True) as pbar:
-                for _ in pool.imap_unordered(unpack, [(download_image, info, tag, only_metadata) for info in infos]):
-                    pbar.update()
-        ids_after = get_downloaded_ids(tag)
-        logging.info(f"{len(ids_after) - len(ids_before)} images downloaded for tag '{tag}'.")
-        
\ No newline at end of file
+        out_base = get_output_folder(tag)
+        if out_base not in unique_tags:
+            unique_tags[out_base] = (tag, only_metadata)
+        elif unique_tags[out_base][0] == tag:
+            unique_tags[out_base] = (tag, unique_tags[out_base][1] and only_metadata) # NOTE: images are downloaded if any of the duplicates asks for them
+        else:
+            logging.warning(f"Tag '{tag}' is saved in the same folder as tag '{unique_tags[out_base][0]}'. Skipping it.")
+    tags = [tag for tag, _ in unique_tags.values()]
+    only_metadatas = [only_metadata for _, only_metadata in unique_tags.values()]
+    logging.info(f"Parallelizing the downloads using {DOWNLOAD_WORKERS} threads.")
+    download_queue = queue.Queue(maxsize=DOWNLOAD_QUEUE_SIZE)
+    stop_event = threading.Event()
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS + 1) as executor, tqdm(total=0, desc="Downloading images", ascii=True) as pbar:
+        workers = [executor.submit(download_worker, download_queue, pbar) for _ in range(DOWNLOAD_WORKERS)]
+        producer = executor.submit(queue_downloads, tags, only_metadatas, download_queue, pbar, stop_event)
+        try:
+            ids_before = producer.result()
+            for _ in workers:
+                download_queue.put(None)
+            wait(workers)
+        except BaseException: # NOTE: e.g. KeyboardInterrupt, the pending downloads are dropped
+            stop_event.set()
+            wait([producer])
+            while True:
+                try:
+                    download_queue.get_nowait()
+                except queue.Empty:
+                    break
+            for _ in workers:
+                download_queue.put(None)
+            raise
+    for out_base, (tag, _) in unique_tags.items():
+        if out_base in ids_before:
+            ids_after = get_downloaded_ids(tag)
+            logging.info(f"{len(ids_after) - len(ids_before[out_base])} images downloaded for tag '{tag}'.")